@@ -211,6 +211,21 @@ setup_virtualenv() {
     print_step "Virtualenv created at .venv/"
 }
 
+# Install pip-only Python packages (also run for an existing virtualenv)
+setup_python_packages() {
+    source "$VENV_DIR/bin/activate"
+
+    # qasync runs asyncio on Qt's event loop; rarely packaged by distros
+    if python3 -c "import qasync" 2>/dev/null; then
+        print_step "qasync is accessible in virtualenv"
+    else
+        print_step "Installing qasync via pip..."
+        pip install qasync
+    fi
+
+    deactivate
+}
+
 # Create shared folder
 setup_shared_folder() {
     if [ -d "$SHARED_FOLDER" ]; then
@@ -316,6 +331,7 @@ main() {
     echo
     echo -e "${BLUE}--- Step 3: Python Virtualenv ---${NC}"
     setup_virtualenv
+    setup_python_packages
 
     # Step 4: Setup shared folder
     echo
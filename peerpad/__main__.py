@@ -3,10 +3,6 @@
 import argparse
 import sys
 
-from PyQt6.QtWidgets import QApplication
-
-from .app import PeerPadWindow
-
 
 def main():
     parser = argparse.ArgumentParser(
@@ -59,10 +55,22 @@ Examples:
         except ValueError:
             pass
 
+    # Qt is slow to import, so only load it once we know we're launching
+    import asyncio
+
+    import qasync
+    from PyQt6.QtWidgets import QApplication
+
+    from .app import PeerPadWindow
+
     # Start Qt application
     app = QApplication(sys.argv)
     app.setApplicationName("PeerPad")
 
+    # Run asyncio on top of Qt's event loop so networking shares the GUI thread
+    loop = qasync.QEventLoop(app)
+    asyncio.set_event_loop(loop)
+
     window = PeerPadWindow(
         host_mode=args.host,
         connect_to=connect_to,
@@ -70,7 +78,8 @@ Examples:
     )
     window.show()
 
-    sys.exit(app.exec())
+    with loop:
+        loop.run_forever()
 
 
 if __name__ == "__main__":
@@ -1,13 +1,14 @@
 """Main application window for PeerPad."""
 
+import asyncio
 import os
-import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from PyQt6.QtWidgets import (
     QMainWindow,
     QWidget,
     QVBoxLayout,
     QHBoxLayout,
-    QTextEdit,
+    QPlainTextEdit,
     QLabel,
     QPushButton,
     QSplitter,
@@ -16,26 +17,41 @@ from PyQt6.QtWidgets import (
     QMessageBox,
 )
 from PyQt6.QtCore import Qt, QTimer
-from PyQt6.QtGui import QAction, QFont
+from PyQt6.QtGui import QAction, QFont, QTextCursor
 
-from .network import NetworkManager, Message, MessageType
-from .widgets import ConnectionDialog
+from .network import TEXT_MESSAGE_TYPES, NetworkManager, Message, MessageType
 from .syncthing import SyncthingManager
 
 
+def _utf16_len(text: str) -> int:
+    """Length of text in UTF-16 code units, the unit QTextCursor positions use."""
+    return len(text.encode("utf-16-le")) // 2
+
+
 class PeerPadWindow(QMainWindow):
     """Main application window."""
 
+    SEND_DELAY_MS = 40
+
     def __init__(self, host_mode: bool = False, connect_to: str = None, port: int = 9876):
         super().__init__()
         self.setWindowTitle("PeerPad")
         self.setMinimumSize(600, 500)
 
-        self._network = NetworkManager()
+        self._network: NetworkManager = None  # Created on first host/connect
+        self._connection_dialog = None  # Created on first use, then reused
         self._syncthing = SyncthingManager()
+        # Syncthing calls block (starting it can take 30s), so they run here,
+        # one at a time, instead of stalling the connection on the GUI thread
+        self._syncthing_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="syncthing")
+        self._my_device_id: str = None
         self._is_connected = False
         self._is_host = False
         self._suppress_text_signal = False
+        self._pending_patches: list[list] = []  # [position, removed, inserted]
+        self._needs_full_sync = False
+        self._doc_length = 0  # Length of our text in UTF-16 units, excluding the final separator
+        self._in_burst = False  # Repaints of their text paused until the burst ends
         self._peer_device_id: str = None
         self._syncthing_ready = False
 
@@ -76,7 +92,7 @@ class PeerPadWindow(QMainWindow):
         your_header.addWidget(self._clear_yours_btn)
         your_layout.addLayout(your_header)
 
-        self._your_text = QTextEdit()
+        self._your_text = QPlainTextEdit()
         self._your_text.setPlaceholderText("Type or paste here... (sent to your peer)")
         self._your_text.setFont(QFont("monospace", 11))
         your_layout.addWidget(self._your_text)
@@ -99,7 +115,7 @@ class PeerPadWindow(QMainWindow):
         their_header.addWidget(self._clear_theirs_btn)
         their_layout.addLayout(their_header)
 
-        self._their_text = QTextEdit()
+        self._their_text = QPlainTextEdit()
         self._their_text.setPlaceholderText("Text from your peer will appear here...")
         self._their_text.setReadOnly(True)
         self._their_text.setFont(QFont("monospace", 11))
@@ -119,9 +135,8 @@ class PeerPadWindow(QMainWindow):
         self._folder_btn = QPushButton("Shared Folder")
         self._sync_status_label = QLabel("")
         self._sync_status_label.setStyleSheet("color: gray; font-size: 11px;")
-        # Create shared folder if it doesn't exist
+        # Created on demand, when opened or shared
         self._shared_folder = os.path.expanduser("~/PeerPad")
-        os.makedirs(self._shared_folder, exist_ok=True)
 
         toolbar.addWidget(self._connection_btn)
         toolbar.addWidget(self._folder_btn)
@@ -135,6 +150,11 @@ class PeerPadWindow(QMainWindow):
         self.setStatusBar(self._status_bar)
         self._update_status("Not connected")
 
+        # Coalesces bursts of keystrokes into a single send
+        self._send_timer = QTimer(self)
+        self._send_timer.setSingleShot(True)
+        self._send_timer.timeout.connect(self._flush_pending_text)
+
     def _setup_menu(self):
         menubar = self.menuBar()
 
@@ -158,15 +178,8 @@ class PeerPadWindow(QMainWindow):
         edit_menu.addAction(clear_yours)
 
     def _connect_signals(self):
-        # Network signals
-        self._network.connected.connect(self._on_connected)
-        self._network.disconnected.connect(self._on_disconnected)
-        self._network.message_received.connect(self._on_message)
-        self._network.error.connect(self._on_error)
-        self._network.client_connected.connect(self._on_client_connected)
-
         # UI signals
-        self._your_text.textChanged.connect(self._on_text_changed)
+        self._your_text.document().contentsChange.connect(self._on_contents_change)
         self._clear_yours_btn.clicked.connect(self._clear_your_text)
         self._connection_btn.clicked.connect(self._show_connection_dialog)
 
@@ -178,11 +191,34 @@ class PeerPadWindow(QMainWindow):
         # Folder button
         self._folder_btn.clicked.connect(self._open_shared_folder)
 
+    def _net(self) -> NetworkManager:
+        """Return the network manager, starting it on first use."""
+        if self._network is None:
+            self._network = NetworkManager()
+            self._connect_network_signals()
+        return self._network
+
+    def _connect_network_signals(self):
+        self._network.connected.connect(self._on_connected)
+        self._network.disconnected.connect(self._on_disconnected)
+        self._network.message_received.connect(self._on_message)
+        self._network.error.connect(self._on_error)
+        self._network.client_connected.connect(self._on_client_connected)
+
     def _update_status(self, msg: str):
         self._status_bar.showMessage(msg)
 
+    def _get_connection_dialog(self):
+        """Return the connection dialog, reset to host mode."""
+        if self._connection_dialog is None:
+            from .widgets import ConnectionDialog
+
+            self._connection_dialog = ConnectionDialog(self)
+        self._connection_dialog.reset()
+        return self._connection_dialog
+
     def _show_connection_dialog(self):
-        dialog = ConnectionDialog(self)
+        dialog = self._get_connection_dialog()
         if dialog.exec():
             mode, host, port = dialog.get_result()
             if mode == "host":
@@ -191,15 +227,14 @@ class PeerPadWindow(QMainWindow):
                 self._start_connect(host, port)
 
     def _show_host_dialog(self):
-        dialog = ConnectionDialog(self)
-        dialog._host_radio.setChecked(True)
+        dialog = self._get_connection_dialog()
         if dialog.exec():
             mode, host, port = dialog.get_result()
             if mode == "host":
                 self._start_host(port)
 
     def _show_connect_dialog(self):
-        dialog = ConnectionDialog(self)
+        dialog = self._get_connection_dialog()
         dialog._connect_radio.setChecked(True)
         dialog._on_mode_changed(False)
         if dialog.exec():
@@ -209,7 +244,7 @@ class PeerPadWindow(QMainWindow):
 
     def _start_host(self, port: int):
         self._is_host = True
-        self._network.host(port)
+        self._net().host(port)
         self._update_status(f"Hosting on port {port}... waiting for connection")
         self._connection_btn.setText("Hosting...")
         self._disconnect_action.setEnabled(True)
@@ -225,12 +260,13 @@ class PeerPadWindow(QMainWindow):
                 pass
 
         self._is_host = False
-        self._network.connect_to(host, port)
+        self._net().connect_to(host, port)
         self._update_status(f"Connecting to {host}:{port}...")
         self._connection_btn.setText("Connecting...")
 
     def _do_disconnect(self):
-        self._network.disconnect()
+        if self._network is not None:
+            self._network.disconnect()
 
     def _on_connected(self):
         self._is_connected = True
@@ -240,10 +276,8 @@ class PeerPadWindow(QMainWindow):
         self._host_action.setEnabled(False)
         self._connect_action.setEnabled(False)
 
-        # Send current text as full sync
-        current = self._your_text.toPlainText()
-        if current:
-            self._network.send_full_sync(current)
+        # Send current text as full sync so later patches have a base
+        self._send_full_text()
 
         # Initiate Syncthing setup
         QTimer.singleShot(100, self._setup_syncthing)
@@ -263,6 +297,12 @@ class PeerPadWindow(QMainWindow):
         self._connect_action.setEnabled(True)
 
     def _on_message(self, msg: Message):
+        if msg.type in TEXT_MESSAGE_TYPES and not self._in_burst:
+            # Messages read in one go repaint once, after they've all been applied
+            self._in_burst = True
+            self._their_text.setUpdatesEnabled(False)
+            QTimer.singleShot(0, self._finish_burst)
+
         self._suppress_text_signal = True
         try:
             if msg.type == MessageType.TEXT:
@@ -274,6 +314,10 @@ class PeerPadWindow(QMainWindow):
             elif msg.type == MessageType.FULL_SYNC:
                 # Replace all text
                 self._their_text.setPlainText(msg.content)
+            elif msg.type == MessageType.PATCH:
+                self._apply_patch(msg)
+            elif msg.type == MessageType.SYNC_REQUEST:
+                self._send_full_text()
             elif msg.type == MessageType.CLEAR:
                 self._their_text.clear()
             elif msg.type == MessageType.SYNCTHING_DEVICE_ID:
@@ -283,29 +327,102 @@ class PeerPadWindow(QMainWindow):
         finally:
             self._suppress_text_signal = False
 
+    def _finish_burst(self):
+        self._in_burst = False
+        self._their_text.setUpdatesEnabled(True)
+
+    def _apply_patch(self, msg: Message):
+        """Apply a peer's incremental edit, resyncing if it doesn't fit."""
+        position, removed, inserted = msg.position, msg.removed, msg.content
+        doc = self._their_text.document()
+        if position < 0 or removed < 0 or position + removed > doc.characterCount() - 1:
+            # Out of step with the peer; ask for the whole text again
+            self._network.send_sync_request()
+            return
+
+        cursor = QTextCursor(doc)
+        cursor.setPosition(position)
+        cursor.setPosition(position + removed, QTextCursor.MoveMode.KeepAnchor)
+        cursor.insertText(inserted)
+
     def _on_error(self, error: str):
         self._update_status(f"Error: {error}")
-        self._connection_btn.setText("Connect...")
+        if not self._is_connected:
+            self._connection_btn.setText("Connect...")
 
-    def _on_text_changed(self):
+    def _on_contents_change(self, position: int, removed: int, added: int):
+        doc = self._your_text.document()
+        old_length = self._doc_length
+        self._doc_length = doc.characterCount() - 1
         if self._suppress_text_signal or not self._is_connected:
             return
 
-        # Get the current text and figure out what changed
-        current = self._your_text.toPlainText()
+        # Qt may count the document's final paragraph separator; clamp to the text
+        removed = min(removed, old_length - position)
+        end = min(position + added, self._doc_length)
+        if position < 0 or removed < 0 or old_length - removed + (end - position) != self._doc_length:
+            self._needs_full_sync = True
+        else:
+            cursor = QTextCursor(doc)
+            cursor.setPosition(position)
+            cursor.setPosition(end, QTextCursor.MoveMode.KeepAnchor)
+            inserted = cursor.selectedText().replace("\u2029", "\n").replace("\u2028", "\n")
+            self._queue_patch(position, removed, inserted)
+
+        # Restarting the timer collapses rapid edits into one send
+        self._send_timer.start(self.SEND_DELAY_MS)
+
+    def _queue_patch(self, position: int, removed: int, inserted: str):
+        """Queue an edit, folding it into the previous one when it lands inside it."""
+        if self._pending_patches:
+            last = self._pending_patches[-1]
+            last_inserted = last[2]
+            offset = position - last[0]
+            # Offsets are UTF-16 units, so only slice text without surrogate pairs
+            if (0 <= offset and offset + removed <= len(last_inserted)
+                    and _utf16_len(last_inserted) == len(last_inserted)):
+                last[2] = last_inserted[:offset] + inserted + last_inserted[offset + removed:]
+                if not last[1] and not last[2]:
+                    self._pending_patches.pop()
+                return
+        self._pending_patches.append([position, removed, inserted])
 
-        # For simplicity, send full sync on every change
-        # A more sophisticated version would track diffs
-        self._network.send_full_sync(current)
+    def _flush_pending_text(self):
+        if not self._is_connected:
+            self._pending_patches.clear()
+            return
+        if self._needs_full_sync:
+            self._send_full_text()
+            return
+        for position, removed, inserted in self._pending_patches:
+            self._network.send_patch(position, removed, inserted)
+        self._pending_patches.clear()
+
+    def _send_full_text(self):
+        """Send our whole text, superseding any pending patches."""
+        self._send_timer.stop()
+        self._pending_patches.clear()
+        self._needs_full_sync = False
+        self._network.send_full_sync(self._your_text.toPlainText())
 
     def _clear_your_text(self):
-        self._your_text.clear()
+        self._send_timer.stop()
+        self._suppress_text_signal = True
+        try:
+            self._your_text.clear()
+        finally:
+            self._suppress_text_signal = False
+        self._pending_patches.clear()
+        self._needs_full_sync = False
         if self._is_connected:
             self._network.send_clear()
 
     def _open_shared_folder(self):
+        import subprocess
+
         # Open in file manager - try dolphin first (KDE), then xdg-open
         try:
+            os.makedirs(self._shared_folder, exist_ok=True)
             if os.path.exists("/usr/bin/dolphin"):
                 subprocess.Popen(["dolphin", self._shared_folder])
             else:
@@ -313,6 +430,24 @@ class PeerPadWindow(QMainWindow):
         except Exception as e:
             print(f"Failed to open folder: {e}")
 
+    def _run_blocking(self, on_done, func, *args):
+        """Run func(*args) on the Syncthing thread, then on_done(result) on this one.
+
+        If func raises, on_done gets None so the caller can report the failure.
+        """
+        def finished(future):
+            if future.cancelled():
+                return
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"Syncthing call failed: {e}")
+                result = None
+            on_done(result)
+
+        future = asyncio.get_event_loop().run_in_executor(self._syncthing_executor, func, *args)
+        future.add_done_callback(finished)
+
     def _setup_syncthing(self):
         """Set up Syncthing after connecting to peer."""
         self._sync_status_label.setText("Setting up sync...")
@@ -328,23 +463,35 @@ class PeerPadWindow(QMainWindow):
                 QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No
             )
             if reply == QMessageBox.StandardButton.Yes:
+                # Setup is retried once the install finishes
                 self._install_syncthing()
             else:
                 self._network.send_syncthing_status("not_installed")
                 self._sync_status_label.setText("Sync: Not available")
-                return
+            return
 
-        # Start Syncthing if not running
-        if not self._syncthing.is_running():
-            self._sync_status_label.setText("Starting Syncthing...")
-            if not self._syncthing.start():
-                self._sync_status_label.setText("Sync: Failed to start")
-                self._network.send_syncthing_status("error")
-                return
+        self._sync_status_label.setText("Starting Syncthing...")
+        self._run_blocking(self._on_syncthing_started, self._start_syncthing)
 
-        # Get and send our device ID
-        device_id = self._syncthing.get_device_id()
+    def _start_syncthing(self):
+        """Start Syncthing if needed; returns (started, device ID). Blocks."""
+        if not self._syncthing.start():
+            return False, None
+        return True, self._syncthing.get_device_id()
+
+    def _on_syncthing_started(self, result):
+        if not self._is_connected:
+            return  # Disconnected while Syncthing was starting
+
+        started, device_id = result or (False, None)
+        if not started:
+            self._sync_status_label.setText("Sync: Failed to start")
+            self._network.send_syncthing_status("error")
+            return
+
+        # Send our device ID
         if device_id:
+            self._my_device_id = device_id
             self._syncthing_ready = True
             self._network.send_syncthing_device_id(device_id)
             self._sync_status_label.setText("Sync: Exchanging IDs...")
@@ -380,28 +527,24 @@ class PeerPadWindow(QMainWindow):
 
         if reply == QMessageBox.StandardButton.Yes:
             self._sync_status_label.setText("Installing Syncthing...")
-            success, message = SyncthingManager.install()
-            if success:
-                QMessageBox.information(self, "Installation Complete", message)
-                # Retry setup after installation
-                QTimer.singleShot(500, self._setup_syncthing)
-            else:
-                QMessageBox.warning(self, "Installation Failed", message)
-                self._network.send_syncthing_status("not_installed")
-                self._sync_status_label.setText("Sync: Not available")
+            self._run_blocking(self._on_syncthing_installed, SyncthingManager.install)
         else:
             self._network.send_syncthing_status("not_installed")
             self._sync_status_label.setText("Sync: Not available")
 
+    def _on_syncthing_installed(self, result):
+        success, message = result or (False, "Installation failed unexpectedly.")
+        if success:
+            QMessageBox.information(self, "Installation Complete", message)
+            # Retry setup after installation
+            QTimer.singleShot(500, self._setup_syncthing)
+        else:
+            QMessageBox.warning(self, "Installation Failed", message)
+            self._network.send_syncthing_status("not_installed")
+            self._sync_status_label.setText("Sync: Not available")
+
     def _handle_peer_device_id(self, device_id: str):
         """Handle receiving peer's Syncthing device ID."""
-        # Check if peer is on the same machine (same device ID)
-        my_device_id = self._syncthing.get_device_id()
-        if my_device_id and device_id == my_device_id:
-            self._sync_status_label.setText("Sync: Same machine")
-            self._sync_status_label.setStyleSheet("color: gray; font-size: 11px;")
-            return
-
         self._peer_device_id = device_id
         # If we're ready, configure the shared folder
         if self._syncthing_ready:
@@ -419,15 +562,34 @@ class PeerPadWindow(QMainWindow):
         if not self._peer_device_id or not self._syncthing_ready:
             return
 
+        # Check if peer is on the same machine (same device ID)
+        if self._peer_device_id == self._my_device_id:
+            self._sync_status_label.setText("Sync: Same machine")
+            self._sync_status_label.setStyleSheet("color: gray; font-size: 11px;")
+            return
+
         self._sync_status_label.setText("Configuring shared folder...")
+        os.makedirs(self._shared_folder, exist_ok=True)
+        self._run_blocking(
+            self._on_shared_folder_configured,
+            self._syncthing.setup_shared_folder, self._shared_folder, self._peer_device_id,
+        )
 
-        if self._syncthing.setup_shared_folder(self._shared_folder, self._peer_device_id):
+    def _on_shared_folder_configured(self, success):
+        if not self._is_connected:
+            return
+        if success:
             self._sync_status_label.setText("Sync: Active")
             self._sync_status_label.setStyleSheet("color: green; font-size: 11px;")
         else:
             self._sync_status_label.setText("Sync: Config failed")
             self._sync_status_label.setStyleSheet("color: orange; font-size: 11px;")
+            if success is None:
+                # The call raised rather than reporting a config failure
+                self._network.send_syncthing_status("error")
 
     def closeEvent(self, event):
-        self._network.cleanup()
+        if self._network is not None:
+            self._network.cleanup()
+        self._syncthing_executor.shutdown(wait=False, cancel_futures=True)
         super().closeEvent(event)
@@ -1,44 +1,109 @@
 """Network module for TCP server/client communication."""
 
 import asyncio
+import functools
+import ipaddress
 import json
 import socket
+import struct
+import time
 from dataclasses import dataclass
 from enum import Enum
 from typing import Optional
 
-from PyQt6.QtCore import QObject, QThread, pyqtSignal
+from PyQt6.QtCore import QObject, pyqtSignal
+
+try:
+    import orjson
+except ImportError:  # Optional speedup, fall back to stdlib json
+    orjson = None
+
+try:
+    import psutil
+except ImportError:  # Optional, fall back to resolving the hostname
+    psutil = None
+
+# Every message is sent as a 4-byte big-endian length followed by JSON
+_HEADER = struct.Struct(">I")
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+# Transport buffer size past which we stop writing and let messages queue
+WRITE_BUFFER_HIGH = 256 * 1024
 
 
 class MessageType(Enum):
     TEXT = "text"
     CLEAR = "clear"
     FULL_SYNC = "full_sync"
+    PATCH = "patch"
     SYNC_REQUEST = "sync_request"
     SYNCTHING_DEVICE_ID = "syncthing_device_id"
     SYNCTHING_STATUS = "syncthing_status"
 
 
-@dataclass
+# Plain dict lookup is cheaper than MessageType(value) per message
+_TYPE_FROM_STR = {t.value: t for t in MessageType}
+
+# Messages that change the peer's view of our text; a FULL_SYNC supersedes them
+TEXT_MESSAGE_TYPES = frozenset({MessageType.TEXT, MessageType.CLEAR, MessageType.FULL_SYNC, MessageType.PATCH})
+
+
+@dataclass(slots=True, frozen=True)
 class Message:
     type: MessageType
     content: str = ""
+    # PATCH only: replace `removed` chars at `position` with `content`
+    position: int = 0
+    removed: int = 0
 
     def to_json(self) -> bytes:
-        data = {"type": self.type.value, "content": self.content}
-        return json.dumps(data).encode() + b"\n"
+        """Encode as a length-prefixed frame."""
+        is_patch = self.type is MessageType.PATCH
+        if not self.content:
+            payload = _CONST_PAYLOADS.get(self.type)
+            if payload is not None:
+                return payload
+        if orjson is not None:
+            fields = {"type": self.type.value, "content": self.content}
+            if is_patch:
+                fields["pos"] = self.position
+                fields["del"] = self.removed
+            payload = orjson.dumps(fields)
+        else:
+            # Type values are plain identifiers, so only content needs the
+            # encoder; this skips building and walking a dict
+            payload = '{"type":"' + self.type.value + '","content":' + json.dumps(self.content)
+            if is_patch:
+                payload += f',"pos":{self.position:d},"del":{self.removed:d}'
+            payload = (payload + '}').encode()
+        return _HEADER.pack(len(payload)) + payload
 
     @classmethod
     def from_json(cls, data: bytes) -> "Message":
-        parsed = json.loads(data.decode())
+        """Decode a frame payload (without the length prefix)."""
+        # Both parsers accept bytes directly, no decode() copy needed
+        parsed = orjson.loads(data) if orjson is not None else json.loads(data)
+        msg_type = _TYPE_FROM_STR[parsed["type"]]
+        if msg_type is MessageType.PATCH:
+            return cls(msg_type, str(parsed["content"]), int(parsed["pos"]), int(parsed["del"]))
         return cls(
-            type=MessageType(parsed["type"]),
+            type=msg_type,
             content=parsed.get("content", "")
         )
 
 
+# Content-less messages always encode to the same bytes
+_CONST_PAYLOADS: dict[MessageType, bytes] = {}
+_CONST_PAYLOADS.update(
+    (t, Message(t).to_json()) for t in (MessageType.CLEAR, MessageType.SYNC_REQUEST)
+)
+
+# Messages are immutable, so content-less ones can be shared
+_CLEAR_MSG = Message(MessageType.CLEAR)
+_SYNC_REQUEST_MSG = Message(MessageType.SYNC_REQUEST)
+
+
 class NetworkWorker(QObject):
-    """Runs asyncio event loop in a separate thread."""
+    """Runs the peer connection on the asyncio loop shared with Qt."""
 
     connected = pyqtSignal()
     disconnected = pyqtSignal()
@@ -48,56 +113,63 @@ class NetworkWorker(QObject):
 
     def __init__(self):
         super().__init__()
-        self._loop: Optional[asyncio.AbstractEventLoop] = None
         self._server: Optional[asyncio.Server] = None
         self._writer: Optional[asyncio.StreamWriter] = None
         self._reader: Optional[asyncio.StreamReader] = None
-        self._running = False
+        self._tasks: set[asyncio.Task] = set()
+        self._send_queue: list[tuple[bytes, MessageType]] = []
+        self._flush_scheduled = False
+        self._draining = False
+        self._running = True
         self._is_host = False
 
-    def run(self):
-        """Main entry point when thread starts."""
-        self._loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(self._loop)
-        self._running = True
-        try:
-            self._loop.run_forever()
-        finally:
-            self._loop.close()
+    def _spawn(self, coro):
+        """Schedule a coroutine, keeping a reference until it finishes."""
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
 
     def stop(self):
-        """Stop the event loop."""
+        """Close the connection and stop serving."""
         self._running = False
-        if self._loop:
-            self._loop.call_soon_threadsafe(self._loop.stop)
+        if self._writer:
+            self._writer.close()
+        if self._server:
+            self._server.close()
+            self._server = None
 
     def host(self, port: int):
         """Start hosting on the given port."""
-        if self._loop:
-            self._loop.call_soon_threadsafe(
-                lambda: asyncio.ensure_future(self._host(port), loop=self._loop)
-            )
+        self._spawn(self._host(port))
 
     def connect(self, host: str, port: int):
         """Connect to a host."""
-        if self._loop:
-            self._loop.call_soon_threadsafe(
-                lambda: asyncio.ensure_future(self._connect(host, port), loop=self._loop)
-            )
+        self._spawn(self._connect(host, port))
 
     def disconnect(self):
         """Disconnect from peer."""
-        if self._loop:
-            self._loop.call_soon_threadsafe(
-                lambda: asyncio.ensure_future(self._disconnect(), loop=self._loop)
-            )
+        self._spawn(self._disconnect())
 
     def send_message(self, msg: Message):
         """Send a message to the peer."""
-        if self._loop and self._writer:
-            self._loop.call_soon_threadsafe(
-                lambda: asyncio.ensure_future(self._send(msg), loop=self._loop)
-            )
+        self.send_data(msg.to_json(), msg.type)
+
+    def send_data(self, data: bytes, msg_type: MessageType):
+        """Send an already-encoded message to the peer."""
+        if not self._writer:
+            return
+        if len(data) - _HEADER.size > MAX_MESSAGE_SIZE:
+            # The peer would drop the connection over it; report it here instead
+            self.error.emit(f"Message too large to send ({len(data) - _HEADER.size} bytes)")
+            return
+        if msg_type is MessageType.FULL_SYNC:
+            # Still-queued text updates are stale once the whole text is resent
+            self._send_queue = [item for item in self._send_queue if item[1] not in TEXT_MESSAGE_TYPES]
+        # Everything queued before the flush runs goes out in one write
+        self._send_queue.append((data, msg_type))
+        if not self._flush_scheduled and not self._draining:
+            self._flush_scheduled = True
+            asyncio.get_event_loop().call_soon(self._flush)
 
     async def _host(self, port: int):
         """Async host implementation."""
@@ -123,6 +195,7 @@ class NetworkWorker(QObject):
 
         self._reader = reader
         self._writer = writer
+        writer.transport.set_write_buffer_limits(high=WRITE_BUFFER_HIGH)
         peer = writer.get_extra_info("peername")
         peer_str = f"{peer[0]}:{peer[1]}" if peer else "unknown"
 
@@ -136,6 +209,7 @@ class NetworkWorker(QObject):
         try:
             self._is_host = False
             self._reader, self._writer = await asyncio.open_connection(host, port)
+            self._writer.transport.set_write_buffer_limits(high=WRITE_BUFFER_HIGH)
             self.connected.emit()
             await self._read_loop()
         except Exception as e:
@@ -143,16 +217,26 @@ class NetworkWorker(QObject):
 
     async def _read_loop(self):
         """Read messages from peer."""
+        # Bind what the loop uses to locals; it runs once per message
+        reader = self._reader
+        read = reader.readexactly
+        unpack = _HEADER.unpack
+        header_size = _HEADER.size
+        parse = Message.from_json
+        emit = self.message_received.emit
+        bad_message = (json.JSONDecodeError, ValueError, KeyError, TypeError)
         try:
-            while self._running and self._reader:
-                line = await self._reader.readline()
-                if not line:
-                    break
+            while self._running and self._reader is reader:
+                (length,) = unpack(await read(header_size))
+                if length > MAX_MESSAGE_SIZE:
+                    raise ValueError(f"message too large ({length} bytes)")
+                payload = await read(length)
                 try:
-                    msg = Message.from_json(line)
-                    self.message_received.emit(msg)
-                except (json.JSONDecodeError, ValueError) as e:
+                    emit(parse(payload))
+                except bad_message as e:
                     print(f"Invalid message: {e}")
+        except asyncio.IncompleteReadError:
+            pass  # Peer closed the connection
         except asyncio.CancelledError:
             pass
         except Exception as e:
@@ -160,14 +244,35 @@ class NetworkWorker(QObject):
         finally:
             await self._disconnect()
 
-    async def _send(self, msg: Message):
-        """Send a message."""
-        if self._writer:
-            try:
-                self._writer.write(msg.to_json())
+    def _flush(self):
+        """Write all queued messages."""
+        self._flush_scheduled = False
+        queue, self._send_queue = self._send_queue, []
+        if not self._writer or not queue:
+            return
+        try:
+            self._writer.writelines([data for data, _ in queue])
+        except Exception as e:
+            self.error.emit(f"Send error: {e}")
+            return
+
+        # The transport buffers the write; once it backs up, hold further
+        # messages in our queue (where stale full syncs can be dropped)
+        transport = self._writer.transport
+        if transport.get_write_buffer_size() > transport.get_write_buffer_limits()[1]:
+            self._draining = True
+            self._spawn(self._drain())
+
+    async def _drain(self):
+        """Wait for the transport's buffer to empty, then send what queued up."""
+        try:
+            if self._writer:
                 await self._writer.drain()
-            except Exception as e:
-                self.error.emit(f"Send error: {e}")
+        except Exception as e:
+            self.error.emit(f"Send error: {e}")
+        finally:
+            self._draining = False
+        self._flush()
 
     async def _disconnect(self):
         """Close connections."""
@@ -179,6 +284,7 @@ class NetworkWorker(QObject):
                 pass
             self._writer = None
             self._reader = None
+            self._send_queue.clear()
             self.disconnected.emit()
 
         if self._server and not self._is_host:
@@ -187,7 +293,7 @@ class NetworkWorker(QObject):
 
 
 class NetworkManager(QObject):
-    """Manages network thread and provides clean interface."""
+    """Owns the network worker and provides clean interface."""
 
     connected = pyqtSignal()
     disconnected = pyqtSignal()
@@ -197,20 +303,17 @@ class NetworkManager(QObject):
 
     def __init__(self):
         super().__init__()
-        self._thread = QThread()
         self._worker = NetworkWorker()
-        self._worker.moveToThread(self._thread)
+        # (text, encoded message) of the last full sync, reused when unchanged
+        self._full_sync_cache: Optional[tuple[str, bytes]] = None
 
         # Connect signals
-        self._thread.started.connect(self._worker.run)
         self._worker.connected.connect(self.connected)
         self._worker.disconnected.connect(self.disconnected)
         self._worker.message_received.connect(self.message_received)
         self._worker.error.connect(self.error)
         self._worker.client_connected.connect(self.client_connected)
 
-        self._thread.start()
-
     def host(self, port: int = 9876):
         """Start hosting."""
         self._worker.host(port)
@@ -229,11 +332,22 @@ class NetworkManager(QObject):
 
     def send_full_sync(self, text: str):
         """Send full text sync."""
-        self._worker.send_message(Message(MessageType.FULL_SYNC, text))
+        cached = self._full_sync_cache
+        if cached is None or cached[0] != text:
+            cached = self._full_sync_cache = (text, Message(MessageType.FULL_SYNC, text).to_json())
+        self._worker.send_data(cached[1], MessageType.FULL_SYNC)
+
+    def send_patch(self, position: int, removed: int, inserted: str):
+        """Send an incremental edit: replace `removed` chars at `position`."""
+        self._worker.send_message(Message(MessageType.PATCH, inserted, position, removed))
+
+    def send_sync_request(self):
+        """Ask the peer to resend its full text."""
+        self._worker.send_message(_SYNC_REQUEST_MSG)
 
     def send_clear(self):
         """Send clear signal."""
-        self._worker.send_message(Message(MessageType.CLEAR))
+        self._worker.send_message(_CLEAR_MSG)
 
     def send_syncthing_device_id(self, device_id: str):
         """Send Syncthing device ID to peer."""
@@ -246,29 +360,60 @@ class NetworkManager(QObject):
     def cleanup(self):
         """Clean shutdown."""
         self._worker.stop()
-        self._thread.quit()
-        self._thread.wait(1000)
 
 
-def get_local_ips() -> list[str]:
-    """Get local IP addresses."""
+_TAILSCALE_NETWORK = ipaddress.ip_network("100.64.0.0/10")
+LOCAL_IPS_TTL = 5  # seconds
+
+
+def get_local_ips() -> tuple[str, ...]:
+    """Get local IP addresses, Tailscale ones first.
+
+    Cached for a few seconds, so reopening the dialog doesn't rescan but
+    interfaces that come and go (VPNs) still show up.
+    """
+    return _local_ips(int(time.monotonic() // LOCAL_IPS_TTL))
+
+
+@functools.lru_cache(maxsize=1)
+def _local_ips(_time_bucket: int) -> tuple[str, ...]:
+    if psutil is not None:
+        # Read straight from the interfaces; no DNS or routing lookups
+        ips = [
+            addr.address
+            for addrs in psutil.net_if_addrs().values()
+            for addr in addrs
+            if addr.family == socket.AF_INET and not addr.address.startswith("127.")
+        ]
+    else:
+        ips = _probe_local_ips()
+
+    ips = list(dict.fromkeys(ips))
+    ips.sort(key=lambda ip: ipaddress.ip_address(ip) not in _TAILSCALE_NETWORK)
+    return tuple(ips)
+
+
+def _probe_local_ips() -> list[str]:
+    """Find local IPs via the hostname and the route to Tailscale."""
     ips = []
     try:
-        # Get all network interfaces
+        # Addresses the hostname resolves to
         hostname = socket.gethostname()
-        ips = socket.gethostbyname_ex(hostname)[2]
-    except (socket.error, socket.herror, socket.gaierror):
+        for *_, sockaddr in socket.getaddrinfo(hostname, None, socket.AF_INET):
+            if sockaddr[0] not in ips:
+                ips.append(sockaddr[0])
+    except OSError:
         pass
 
     # Also try to get Tailscale IP (usually 100.x.x.x)
     try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.connect(("100.100.100.100", 80))  # Tailscale magic DNS
-        ip = s.getsockname()[0]
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.settimeout(0.2)
+            s.connect(("100.100.100.100", 80))  # Tailscale magic DNS
+            ip = s.getsockname()[0]
         if ip not in ips:
             ips.insert(0, ip)
-        s.close()
-    except (socket.error, OSError):
+    except OSError:
         pass
 
     return ips
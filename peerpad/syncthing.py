@@ -1,14 +1,57 @@
 """Syncthing integration for PeerPad shared folder sync."""
 
+import functools
 import os
+import shutil
 import subprocess
+import threading
 import time
-import xml.etree.ElementTree as ET
-from pathlib import Path
-from typing import Optional
+from typing import Callable, Iterator, Optional
 
 import requests
 
+try:
+    from lxml import etree as ET
+except ImportError:  # Optional speedup, fall back to the stdlib parser
+    import xml.etree.ElementTree as ET
+
+# Where Syncthing may have written its config (and API key)
+_HOME = os.path.expanduser("~")
+_CONFIG_PATHS = (
+    os.path.join(_HOME, ".config", "syncthing", "config.xml"),
+    os.path.join(_HOME, ".local", "state", "syncthing", "config.xml"),
+    "/var/lib/syncthing/.config/syncthing/config.xml",
+)
+
+
+@functools.lru_cache(maxsize=1)
+def _syncthing_installed() -> bool:
+    return shutil.which("syncthing") is not None
+
+
+_ARCH_IDS = {"arch", "cachyos", "manjaro"}
+_DEBIAN_IDS = {"ubuntu", "debian", "pop", "linuxmint", "mint"}
+
+
+@functools.lru_cache(maxsize=1)
+def _detect_distro() -> Optional[str]:
+    fields = {}
+    try:
+        with open("/etc/os-release") as f:
+            for line in f:
+                key, _, value = line.partition("=")
+                fields[key.strip()] = value.strip().strip('"').lower()
+    except FileNotFoundError:
+        return None
+
+    # ID first, then the families listed in ID_LIKE
+    for distro_id in (fields.get("ID", ""), *fields.get("ID_LIKE", "").split()):
+        if distro_id in _ARCH_IDS:
+            return "arch"
+        if distro_id in _DEBIAN_IDS:
+            return "debian"
+    return None
+
 
 class SyncthingManager:
     """Manages Syncthing for folder synchronization."""
@@ -16,29 +59,50 @@ class SyncthingManager:
     DEFAULT_API_URL = "http://127.0.0.1:8384"
     PEERPAD_FOLDER_ID = "peerpad-shared"
     PEERPAD_FOLDER_LABEL = "PeerPad"
+    CONFIG_CACHE_TTL = 1.0  # seconds
+    API_KEY_RETRY_INTERVAL = 0.5  # seconds between config file probes
+
+    # Defaults for the config entries we create; copied and filled in per use.
+    # Tuples keep the shared values immutable.
+    _DEVICE_TEMPLATE = {
+        "addresses": ("dynamic",),
+        "compression": "metadata",
+        "introducer": False,
+        "paused": False,
+        "autoAcceptFolders": False,
+    }
+    _FOLDER_TEMPLATE = {
+        "type": "sendreceive",
+        "rescanIntervalS": 60,
+        "fsWatcherEnabled": True,
+        "fsWatcherDelayS": 1,
+        "ignorePerms": False,
+        "autoNormalize": True,
+    }
+    _FOLDER_DEVICE_TEMPLATE = {"introducedBy": "", "encryptionPassword": ""}
 
     def __init__(self, api_url: str = DEFAULT_API_URL):
         self._api_url = api_url
         self._api_key: Optional[str] = None
+        # Last failed probe, so callers don't reread the files on every request
+        self._api_key_last_miss = 0.0
+        self._api_key_lock = threading.Lock()
         self._process: Optional[subprocess.Popen] = None
+        self._device_id: Optional[str] = None
+        self._config_cache: Optional[dict] = None
+        self._config_cache_time = 0.0
+        # Keeps the localhost connection alive between API calls
+        self._session = requests.Session()
 
     @staticmethod
     def is_installed() -> bool:
-        """Check if Syncthing is installed."""
-        try:
-            result = subprocess.run(
-                ["syncthing", "--version"],
-                capture_output=True,
-                timeout=5
-            )
-            return result.returncode == 0
-        except (subprocess.SubprocessError, FileNotFoundError):
-            return False
+        """Check if Syncthing is installed (on PATH; cached)."""
+        return _syncthing_installed()
 
     def is_running(self) -> bool:
         """Check if Syncthing is running by trying to connect to API."""
         try:
-            resp = requests.get(
+            resp = self._session.get(
                 f"{self._api_url}/rest/system/ping",
                 timeout=2
             )
@@ -47,31 +111,43 @@ class SyncthingManager:
             return False
 
     def get_api_key(self) -> Optional[str]:
-        """Get API key from Syncthing config file."""
+        """Get API key from Syncthing config file.
+
+        A miss is remembered for API_KEY_RETRY_INTERVAL, so requests made
+        before Syncthing has written its config don't each reread it.
+        """
         if self._api_key:
             return self._api_key
 
-        config_paths = [
-            Path.home() / ".config" / "syncthing" / "config.xml",
-            Path.home() / ".local" / "state" / "syncthing" / "config.xml",
-            Path("/var/lib/syncthing/.config/syncthing/config.xml"),
-        ]
+        with self._api_key_lock:
+            # Another thread may have found it while we waited
+            if self._api_key:
+                return self._api_key
+            if time.monotonic() - self._api_key_last_miss < self.API_KEY_RETRY_INTERVAL:
+                return None
 
-        for config_path in config_paths:
-            if config_path.exists():
+            for config_path in _CONFIG_PATHS:
+                # Stream the file and stop at the key (it's only under <gui>)
+                # rather than building the whole device/folder tree
                 try:
-                    tree = ET.parse(config_path)
-                    root = tree.getroot()
-                    gui = root.find("gui")
-                    if gui is not None:
-                        api_key = gui.find("apikey")
-                        if api_key is not None and api_key.text:
-                            self._api_key = api_key.text
+                    for _, elem in ET.iterparse(config_path):
+                        if elem.tag == "apikey" and elem.text:
+                            # Sent with every request from now on
+                            self._session.headers["X-API-Key"] = elem.text
+                            self._api_key = elem.text
                             return self._api_key
-                except ET.ParseError:
+                        elem.clear()
+                except (OSError, ET.ParseError):
                     continue
 
-        return None
+            self._api_key_last_miss = time.monotonic()
+            return None
+
+    def _forget_api_key(self):
+        """Drop the cached key (and any remembered miss) so it's reread."""
+        with self._api_key_lock:
+            self._api_key = None
+            self._api_key_last_miss = 0.0
 
     def start(self, timeout: int = 30) -> bool:
         """Start Syncthing if not running. Returns True if started successfully."""
@@ -81,6 +157,7 @@ class SyncthingManager:
         if not self.is_installed():
             return False
 
+        self._device_id = None  # A fresh instance may generate new keys
         try:
             self._process = subprocess.Popen(
                 ["syncthing", "serve", "--no-browser"],
@@ -90,17 +167,21 @@ class SyncthingManager:
             )
 
             # Wait for API to become available AND config file to be written
-            # On first run, Syncthing generates keys/certs which takes time
-            start_time = time.time()
-            while time.time() - start_time < timeout:
+            # On first run, Syncthing generates keys/certs which takes time.
+            # Poll quickly at first, backing off towards 0.5s.
+            deadline = time.monotonic() + timeout
+            interval = 0.025
+            while time.monotonic() < deadline:
                 if self.is_running():
                     # API is up, now wait for config file with API key
                     # This is crucial on first run when keys are being generated
-                    self._api_key = None  # Reset cached key
-                    if self.get_api_key():
+                    self._forget_api_key()
+                    # Ready once the API answers with our device ID
+                    if self.get_api_key() and self.get_device_id():
                         return True
                     # Config not ready yet, keep waiting
-                time.sleep(0.5)
+                time.sleep(interval)
+                interval = min(interval * 1.5, 0.5)
 
             return False
         except (subprocess.SubprocessError, FileNotFoundError):
@@ -108,19 +189,21 @@ class SyncthingManager:
 
     def _request(self, method: str, endpoint: str, **kwargs) -> Optional[requests.Response]:
         """Make an authenticated request to the Syncthing API."""
-        api_key = self.get_api_key()
-        if not api_key:
+        # The key is set as a session header when it's first read
+        if not self.get_api_key():
             return None
 
-        headers = kwargs.pop("headers", {})
-        headers["X-API-Key"] = api_key
+        timeout = kwargs.pop("timeout", 10)
+
+        if method != "GET":
+            # Any write may change the config
+            self._config_cache = None
 
         try:
-            resp = requests.request(
+            resp = self._session.request(
                 method,
-                f"{self._api_url}{endpoint}",
-                headers=headers,
-                timeout=10,
+                self._api_url + endpoint,
+                timeout=timeout,
                 **kwargs
             )
             return resp
@@ -128,23 +211,42 @@ class SyncthingManager:
             return None
 
     def get_device_id(self) -> Optional[str]:
-        """Get this machine's Syncthing device ID."""
+        """Get this machine's Syncthing device ID.
+
+        Cached once known: it's derived from Syncthing's keys, which don't
+        change while it runs.
+        """
+        if self._device_id:
+            return self._device_id
+
         resp = self._request("GET", "/rest/system/status")
         if resp and resp.status_code == 200:
             data = resp.json()
-            return data.get("myID")
+            self._device_id = data.get("myID")
+            return self._device_id
         return None
 
     def get_config(self) -> Optional[dict]:
-        """Get the full Syncthing configuration."""
+        """Get the full Syncthing configuration.
+
+        Cached for CONFIG_CACHE_TTL seconds, and dropped whenever we write
+        to the API.
+        """
+        if (self._config_cache is not None
+                and time.monotonic() - self._config_cache_time < self.CONFIG_CACHE_TTL):
+            return self._config_cache
+
         resp = self._request("GET", "/rest/config")
         if resp and resp.status_code == 200:
-            return resp.json()
+            self._config_cache = resp.json()
+            self._config_cache_time = time.monotonic()
+            return self._config_cache
         return None
 
-    def device_exists(self, device_id: str) -> bool:
+    def device_exists(self, device_id: str, config: Optional[dict] = None) -> bool:
         """Check if a device is already configured."""
-        config = self.get_config()
+        if config is None:
+            config = self.get_config()
         if not config:
             return False
 
@@ -153,27 +255,30 @@ class SyncthingManager:
                 return True
         return False
 
-    def add_device(self, device_id: str, name: str = "PeerPad Peer") -> bool:
+    def add_device(self, device_id: str, name: str = "PeerPad Peer",
+                   config: Optional[dict] = None) -> bool:
         """Add a device to Syncthing."""
-        if self.device_exists(device_id):
+        if self.device_exists(device_id, config):
             return True  # Already exists
 
-        device_config = {
-            "deviceID": device_id,
-            "name": name,
-            "addresses": ["dynamic"],
-            "compression": "metadata",
-            "introducer": False,
-            "paused": False,
-            "autoAcceptFolders": False,
-        }
-
-        resp = self._request("POST", "/rest/config/devices", json=device_config)
+        resp = self._request("POST", "/rest/config/devices", json=self._new_device_config(device_id, name))
         return resp is not None and resp.status_code in (200, 201)
 
-    def folder_exists(self, folder_id: str = PEERPAD_FOLDER_ID) -> bool:
+    @classmethod
+    def _new_device_config(cls, device_id: str, name: str = "PeerPad Peer") -> dict:
+        """Build the config entry for a newly added device."""
+        return {**cls._DEVICE_TEMPLATE, "deviceID": device_id, "name": name}
+
+    @classmethod
+    def _folder_device(cls, device_id: str) -> dict:
+        """Build a folder's entry for a device it's shared with."""
+        return {**cls._FOLDER_DEVICE_TEMPLATE, "deviceID": device_id}
+
+    def folder_exists(self, folder_id: str = PEERPAD_FOLDER_ID,
+                      config: Optional[dict] = None) -> bool:
         """Check if the PeerPad folder is already configured."""
-        config = self.get_config()
+        if config is None:
+            config = self.get_config()
         if not config:
             return False
 
@@ -182,9 +287,11 @@ class SyncthingManager:
                 return True
         return False
 
-    def get_folder_devices(self, folder_id: str = PEERPAD_FOLDER_ID) -> list[str]:
+    def get_folder_devices(self, folder_id: str = PEERPAD_FOLDER_ID,
+                           config: Optional[dict] = None) -> list[str]:
         """Get list of device IDs sharing a folder."""
-        config = self.get_config()
+        if config is None:
+            config = self.get_config()
         if not config:
             return []
 
@@ -193,57 +300,62 @@ class SyncthingManager:
                 return [d.get("deviceID") for d in folder.get("devices", [])]
         return []
 
+    @staticmethod
+    def _index_config(config: dict) -> dict:
+        """Map device and folder IDs to their entries in `config` (not copies)."""
+        return {
+            "devices": {d.get("deviceID"): d for d in config.get("devices", [])},
+            "folders": {f.get("id"): f for f in config.get("folders", [])},
+        }
+
+    def _apply_config_changes(self, mutator: Callable[[dict], bool]) -> bool:
+        """Read-modify-write the whole config with a single PUT.
+
+        `mutator` edits the config in place and returns whether it changed
+        anything; nothing is written if it didn't.
+        """
+        config = self.get_config()
+        if not config:
+            return False
+        if not mutator(config):
+            return True
+        resp = self._request("PUT", "/rest/config", json=config)
+        return resp is not None and resp.status_code == 200
+
     def setup_shared_folder(self, folder_path: str, peer_device_id: str) -> bool:
         """Set up the shared folder with peer device."""
         my_device_id = self.get_device_id()
         if not my_device_id:
             return False
 
-        # Ensure peer device is added
-        if not self.add_device(peer_device_id):
-            return False
-
-        if self.folder_exists():
-            # Folder exists, just add the peer device if not already shared
-            existing_devices = self.get_folder_devices()
-            if peer_device_id in existing_devices:
-                return True  # Already configured
+        def share_with_peer(config: dict) -> bool:
+            index = self._index_config(config)
+            changed = False
+
+            # Ensure peer device is added
+            if peer_device_id not in index["devices"]:
+                config.setdefault("devices", []).append(self._new_device_config(peer_device_id))
+                changed = True
+
+            folder = index["folders"].get(self.PEERPAD_FOLDER_ID)
+            if folder is not None:
+                # Folder exists, just add the peer device if not already shared
+                if any(d.get("deviceID") == peer_device_id for d in folder.get("devices", [])):
+                    return changed
+                folder.setdefault("devices", []).append(self._folder_device(peer_device_id))
+                return True
 
-            # Add peer to existing folder
-            config = self.get_config()
-            if not config:
-                return False
-
-            for folder in config.get("folders", []):
-                if folder.get("id") == self.PEERPAD_FOLDER_ID:
-                    folder["devices"].append({
-                        "deviceID": peer_device_id,
-                        "introducedBy": "",
-                        "encryptionPassword": ""
-                    })
-                    resp = self._request("PUT", "/rest/config/folders/" + self.PEERPAD_FOLDER_ID, json=folder)
-                    return resp is not None and resp.status_code == 200
-            return False
-        else:
             # Create new folder
-            folder_config = {
+            config.setdefault("folders", []).append({
+                **self._FOLDER_TEMPLATE,
                 "id": self.PEERPAD_FOLDER_ID,
                 "label": self.PEERPAD_FOLDER_LABEL,
                 "path": folder_path,
-                "type": "sendreceive",
-                "devices": [
-                    {"deviceID": my_device_id, "introducedBy": "", "encryptionPassword": ""},
-                    {"deviceID": peer_device_id, "introducedBy": "", "encryptionPassword": ""}
-                ],
-                "rescanIntervalS": 60,
-                "fsWatcherEnabled": True,
-                "fsWatcherDelayS": 1,
-                "ignorePerms": False,
-                "autoNormalize": True,
-            }
-
-            resp = self._request("POST", "/rest/config/folders", json=folder_config)
-            return resp is not None and resp.status_code in (200, 201)
+                "devices": [self._folder_device(my_device_id), self._folder_device(peer_device_id)],
+            })
+            return True
+
+        return self._apply_config_changes(share_with_peer)
 
     def get_folder_status(self, folder_id: str = PEERPAD_FOLDER_ID) -> Optional[dict]:
         """Get the sync status of a folder."""
@@ -252,19 +364,69 @@ class SyncthingManager:
             return resp.json()
         return None
 
+    def stream_folder_events(self, folder_id: str = PEERPAD_FOLDER_ID, since: Optional[int] = None,
+                             timeout: int = 60, poll_interval: float = 5.0) -> Iterator[dict]:
+        """Yield FolderSummary/StateChanged events for a folder as they happen.
+
+        Long-polls /rest/events, so events arrive as soon as Syncthing emits
+        them. Starts after event `since`, or by default after the latest one,
+        so Syncthing's buffered history isn't replayed. If the events API is
+        unavailable, falls back to polling /rest/db/status every
+        poll_interval seconds and yields the result shaped as a
+        FolderSummary event. Never returns; run it off the GUI thread. It
+        uses its own HTTP session, so other calls can go on meanwhile.
+        """
+        with requests.Session() as session:
+            def get_json(endpoint: str, request_timeout: float) -> tuple[Optional[int], object]:
+                """GET an endpoint; returns (status code, parsed body or None)."""
+                api_key = self.get_api_key()
+                if not api_key:
+                    return None, None
+                try:
+                    resp = session.get(
+                        self._api_url + endpoint,
+                        headers={"X-API-Key": api_key},
+                        timeout=request_timeout
+                    )
+                    if resp.status_code != 200:
+                        return resp.status_code, None
+                    return resp.status_code, resp.json()
+                except (requests.RequestException, ValueError):
+                    return None, None
+
+            use_events = True
+            while True:
+                if use_events and since is None:
+                    # Find the latest event ID without waiting for new ones
+                    status, latest = get_json("/rest/events?limit=1&timeout=0", 10)
+                    if latest is not None:
+                        since = latest[-1].get("id", 0) if latest else 0
+                    elif status == 404:
+                        use_events = False
+
+                if use_events and since is not None:
+                    status, events = get_json(
+                        f"/rest/events?since={since}&timeout={timeout}&events=FolderSummary,StateChanged",
+                        timeout + 10,
+                    )
+                    if events is not None:
+                        for event in events:
+                            since = max(since, event.get("id", since))
+                            if (event.get("data") or {}).get("folder") == folder_id:
+                                yield event
+                        continue
+                    if status == 404:
+                        use_events = False
+
+                _, summary = get_json(f"/rest/db/status?folder={folder_id}", 10)
+                if summary is not None:
+                    yield {"type": "FolderSummary", "data": {"folder": folder_id, "summary": summary}}
+                time.sleep(poll_interval)
+
     @staticmethod
     def get_distro() -> Optional[str]:
-        """Detect the Linux distribution type."""
-        try:
-            with open("/etc/os-release") as f:
-                content = f.read().lower()
-                if "arch" in content or "cachyos" in content or "manjaro" in content:
-                    return "arch"
-                elif "ubuntu" in content or "debian" in content or "pop" in content or "mint" in content:
-                    return "debian"
-        except FileNotFoundError:
-            pass
-        return None
+        """Detect the Linux distribution type (cached)."""
+        return _detect_distro()
 
     @staticmethod
     def get_install_command() -> Optional[list[str]]:
@@ -284,13 +446,17 @@ class SyncthingManager:
             return False, "Unknown distribution. Please install Syncthing manually."
 
         try:
+            # Only stderr is reported, so don't buffer stdout
             result = subprocess.run(
                 cmd,
-                capture_output=True,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
                 text=True,
                 timeout=120
             )
             if result.returncode == 0:
+                _syncthing_installed.cache_clear()
                 return True, "Syncthing installed successfully!"
             else:
                 return False, f"Installation failed: {result.stderr}"
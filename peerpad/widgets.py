@@ -13,11 +13,32 @@ from PyQt6.QtWidgets import (
     QGroupBox,
     QMessageBox,
 )
-from PyQt6.QtCore import Qt
+from PyQt6.QtCore import QObject, QThreadPool, Qt, pyqtSignal
 
 from .network import get_local_ips
 
 
+class _IpLookup(QObject):
+    """Carries local IPs looked up on a pool thread back to the GUI thread."""
+
+    found = pyqtSignal(object)  # tuple[str, ...]
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._pending = False
+        self.found.connect(self._on_found)
+
+    def start(self):
+        """Start a lookup unless one is already running."""
+        if self._pending:
+            return
+        self._pending = True
+        QThreadPool.globalInstance().start(lambda: self.found.emit(get_local_ips()))
+
+    def _on_found(self, _ips):
+        self._pending = False
+
+
 class ConnectionDialog(QDialog):
     """Dialog for choosing host or connect mode."""
 
@@ -57,14 +78,15 @@ class ConnectionDialog(QDialog):
         self._host_info = QGroupBox("Your IPs (share one with your friend)")
         host_info_layout = QVBoxLayout(self._host_info)
 
-        ips = get_local_ips()
-        if ips:
-            for ip in ips:
-                ip_label = QLabel(f"  {ip}")
-                ip_label.setTextInteractionFlags(Qt.TextInteractionFlag.TextSelectableByMouse)
-                host_info_layout.addWidget(ip_label)
-        else:
-            host_info_layout.addWidget(QLabel("  (Could not detect IPs)"))
+        # One selectable label holds every IP, one per line.
+        # Looking up IPs can block on DNS, so fill them in when they arrive
+        self._ips_label = QLabel()
+        self._ips_label.setTextInteractionFlags(Qt.TextInteractionFlag.TextSelectableByMouse)
+        host_info_layout.addWidget(self._ips_label)
+        self._show_ips(None)
+        self._ip_lookup = _IpLookup(self)
+        self._ip_lookup.found.connect(self._show_ips)
+        self._ip_lookup.start()
 
         layout.addWidget(self._host_info)
 
@@ -106,6 +128,22 @@ class ConnectionDialog(QDialog):
         self._ok_btn.clicked.connect(self._on_ok)
         self._cancel_btn.clicked.connect(self.reject)
 
+    def reset(self):
+        """Return to host mode for reuse, keeping the last typed host and port."""
+        self._host = ""
+        self._host_radio.setChecked(True)
+        self._on_mode_changed(True)
+        self._ip_lookup.start()
+
+    def _show_ips(self, ips):
+        """Replace the IP list; None means the lookup is still running."""
+        if ips is None:
+            self._ips_label.setText("  (Detecting IPs...)")
+        elif ips:
+            self._ips_label.setText("\n".join(f"  {ip}" for ip in ips))
+        else:
+            self._ips_label.setText("  (Could not detect IPs)")
+
     def _on_mode_changed(self, checked: bool):
         if checked:  # Host mode
             self._mode = "host"